@@ -1,7 +1,16 @@
 import os
+import sys
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import re
 import time
-import requests
+import sqlite3
+import ijson
+import httpx
+import threading
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor
 import yt_dlp
 from slack_bolt import App
 from dotenv import load_dotenv
@@ -9,13 +18,82 @@ import google.generativeai as genai
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Shared across worker threads; HTTP/2 multiplexes concurrent requests to the same host
+_HTTP = httpx.Client(http2=True, timeout=15, follow_redirects=True, limits=httpx.Limits(max_connections=64))
+
+# Caps concurrent caption downloads so the thread pool doesn't hammer one host
+_CAPTION_SLOTS = threading.BoundedSemaphore(8)
+
+# Compiled once; used for every message in the batch
+_YT_URL_RE = re.compile(r"https?://(?:www\.)?(?:youtube\.com|youtu\.be)/\S+")
+_VIDEO_ID_RE = re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})")
+_GH_URL_RE = re.compile(r"https?://github\.com/\S+")
+
+# --- Rate Limiting ---
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills `rate` tokens per second up to `capacity`.
+    Starts with `tokens` available (full by default).
+    acquire() blocks until enough tokens are available.
+    """
+    def __init__(self, rate, capacity, tokens=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity if tokens is None else tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity) # a single oversized request must still get through
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Defaults match the Gemini free tier; override for paid quotas
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+
+# A full bucket plus a minute of refill would allow ~2x the quota in the first
+# minute, so requests are paced one at a time and the token budget starts empty
+_GEMINI_REQUESTS = TokenBucket(GEMINI_RPM / 60, 1)
+_GEMINI_TOKENS = TokenBucket(GEMINI_TPM / 60, GEMINI_TPM, tokens=0)
+# Slack allows roughly one chat.postMessage per second per channel
+_SLACK_POSTS = TokenBucket(1, 1)
+
 # --- YouTube Utils (yt-dlp) ---
 
-def get_video_data(url):
+def get_video_id(url):
     """
-    Fetches video metadata (title, description) and transcript using yt-dlp.
-    Returns: (title, description, transcript_text)
+    Extracts the 11-character YouTube video ID from a URL, or None.
+    """
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def iter_json_items(chunks, prefix):
     """
+    Incrementally yields the JSON items under `prefix` from an iterable of byte chunks.
+    (ijson.items() wants a file object, which httpx's streamed responses don't expose.)
+    """
+    items = ijson.sendable_list()
+    coro = ijson.items_coro(items, prefix)
+    for chunk in chunks:
+        coro.send(chunk)
+        yield from items
+        del items[:]
+    coro.close()
+    yield from items
+
+def _ydl_opts():
     ydl_opts = {
         'quiet': True,
         'skip_download': True,
@@ -26,76 +104,210 @@ def get_video_data(url):
     
     if os.path.exists('yt_cookies.txt'):
         ydl_opts['cookiefile'] = 'yt_cookies.txt'
+    return ydl_opts
+
+# YoutubeDL isn't thread-safe, so each worker thread keeps its own instance.
+# All of them are also tracked so close_ydls() can close them when the pool is done.
+_YDL_LOCAL = threading.local()
+_YDL_INSTANCES = []
+_YDL_INSTANCES_LOCK = threading.Lock()
 
+def get_ydl():
+    """
+    Returns the current thread's YoutubeDL, creating it on first use so
+    extractor setup happens once per worker rather than once per video.
+    """
+    ydl = getattr(_YDL_LOCAL, 'ydl', None)
+    if ydl is None:
+        ydl = _YDL_LOCAL.ydl = yt_dlp.YoutubeDL(_ydl_opts())
+        with _YDL_INSTANCES_LOCK:
+            _YDL_INSTANCES.append(ydl)
+    return ydl
+
+def close_ydls():
+    """
+    Closes every YoutubeDL created by get_ydl() (saves the cookie jar and
+    shuts down its request handlers). Call once no worker is using them.
+    """
+    with _YDL_INSTANCES_LOCK:
+        instances = _YDL_INSTANCES[:]
+        del _YDL_INSTANCES[:]
+    for ydl in instances:
+        try:
+            ydl.close()
+        except Exception as e:
+            logger.error("Error closing yt-dlp: %s", e)
+
+def get_video_data(ydl, url):
+    """
+    Fetches video metadata (title, description) and transcript using yt-dlp.
+    Returns: (title, description, transcript_text)
+    """
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            title = info.get('title', 'Unknown Title')
-            description = info.get('description', 'No description found.')
-            
-            # Transcript Extraction
-            transcript_text = ""
-            captions = info.get('automatic_captions') or info.get('subtitles')
+        info = ydl.extract_info(url, download=False)
+        
+        title = info.get('title', 'Unknown Title')
+        description = info.get('description', 'No description found.')
+        
+        # Transcript Extraction
+        transcript_text = ""
+        captions = info.get('automatic_captions') or info.get('subtitles')
+        
+        if captions:
+            # Try to find English captions
+            # 'en' is standard, but sometimes it's 'en-orig' or 'en-US'
+            # We'll look for any key starting with 'en'
+            en_key = next((k for k in captions.keys() if k.startswith('en')), None)
             
-            if captions:
-                # Try to find English captions
-                # 'en' is standard, but sometimes it's 'en-orig' or 'en-US'
-                # We'll look for any key starting with 'en'
-                en_key = next((k for k in captions.keys() if k.startswith('en')), None)
+            if en_key:
+                tracks = captions[en_key]
+                # Prefer 'json3' format for easy parsing, fallback to 'vtt'
+                # We need the URL to fetch it
+                track_url = next((t['url'] for t in tracks if t['ext'] == 'json3'), None)
                 
-                if en_key:
-                    tracks = captions[en_key]
-                    # Prefer 'json3' format for easy parsing, fallback to 'vtt'
-                    # We need the URL to fetch it
-                    track_url = next((t['url'] for t in tracks if t['ext'] == 'json3'), None)
-                    
-                    if track_url:
-                        try:
-                            r = requests.get(track_url)
+                if track_url:
+                    try:
+                        with _CAPTION_SLOTS, _HTTP.stream("GET", track_url) as r:
                             r.raise_for_status()
-                            data = r.json()
                             
-                            # Parse JSON3 format
+                            # Parse JSON3 format one event at a time instead of loading the whole body
                             # Structure: {'events': [{'segs': [{'utf8': 'text'}]}]}
-                            text_parts = []
-                            for event in data.get('events', []):
-                                if 'segs' in event:
-                                    for seg in event['segs']:
-                                        if 'utf8' in seg:
-                                            text_parts.append(seg['utf8'])
-                            transcript_text = "".join(text_parts) # json3 segments often include spaces
-                        except Exception as e:
-                            print(f"Error fetching/parsing transcript JSON: {e}")
-                    else:
-                        print("No JSON3 caption track found.")
+                            transcript_text = "".join( # json3 segments often include spaces
+                                text
+                                for event in iter_json_items(r.iter_bytes(), 'events.item')
+                                for seg in event.get('segs', ())
+                                if (text := seg.get('utf8')) is not None
+                            )
+                    except Exception as e:
+                        logger.error("Error fetching/parsing transcript JSON: %s", e)
                 else:
-                    print("No English captions found.")
+                    logger.warning("No JSON3 caption track found.")
             else:
-                print("No captions found.")
+                logger.warning("No English captions found.")
+        else:
+            logger.warning("No captions found.")
 
-            return title, description, transcript_text
+        return title, description, transcript_text
 
     except Exception as e:
-        print(f"Error in yt-dlp: {e}")
+        logger.error("Error in yt-dlp: %s", e)
         return None, None, None
 
+# --- Video Cache (SQLite) ---
+
+# Persisted between runs so videos still inside the history window aren't re-fetched
+CACHE_PATH = os.path.join('.cache', 'yt.sqlite3')
+CACHE_TTL = 7 * 24 * 60 * 60 # 7 days
+
+def _cache_connect():
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        "video_id TEXT PRIMARY KEY, title TEXT, description TEXT, transcript TEXT, fetched_at REAL)"
+    )
+    return conn
+
+def cache_get(video_id):
+    """
+    Returns (title, description, transcript_text) for a cached video, or None.
+    Entries older than CACHE_TTL or without a transcript count as a miss.
+    """
+    try:
+        conn = _cache_connect()
+        try:
+            row = conn.execute(
+                "SELECT title, description, transcript FROM cache WHERE video_id = ? AND fetched_at > ?",
+                (video_id, time.time() - CACHE_TTL),
+            ).fetchone()
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Error reading video cache: %s", e)
+        return None
+
+    if not row or not row[2]:
+        return None
+    return row
+
+def cache_put(video_id, title, description, transcript_text):
+    try:
+        conn = _cache_connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                    (video_id, title, description, transcript_text, time.time()),
+                )
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Error writing video cache: %s", e)
+
+def get_video_data_cached(url):
+    """
+    Same as get_video_data, but checks the on-disk cache first.
+    Only results with a transcript are stored.
+    """
+    video_id = get_video_id(url)
+    if video_id:
+        cached = cache_get(video_id)
+        if cached:
+            logger.info("  -> Using cached data for video %s.", video_id)
+            return cached
+
+    title, description, transcript_text = get_video_data(get_ydl(), url)
+    if video_id and title and transcript_text:
+        cache_put(video_id, title, description, transcript_text)
+    return title, description, transcript_text
+
 # --- AI Agent ---
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
-def analyze_transcript(transcript_text, video_title, video_description, github_url):
+# Built once and shared by all workers
+_MODEL = genai.GenerativeModel('gemini-2.5-flash') if GEMINI_API_KEY else None
+
+# Transcript budget for the prompt; cl100k_base stands in for Gemini's tokenizer
+MAX_TRANSCRIPT_TOKENS = 8000
+# Used instead when the tokenizer can't be loaded
+MAX_TRANSCRIPT_CHARS = 25000
+
+_ENC = None # None: not loaded yet, False: loading failed
+_ENC_LOCK = threading.Lock()
+
+def _get_encoding():
     """
-    Analyzes the transcript using Gemini to provide a summary, QA, and project ideas.
+    Loads the tokenizer on first use (it may need to download its BPE file).
+    Returns None if it can't be loaded.
     """
-    if not GEMINI_API_KEY:
-        return "Error: GEMINI_API_KEY not found."
+    global _ENC
+    with _ENC_LOCK:
+        if _ENC is None:
+            try:
+                _ENC = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                logger.warning("Could not load tokenizer, truncating by characters: %s", e)
+                _ENC = False
+        return _ENC if _ENC is not False else None
+
+def truncate_tokens(text, max_tokens):
+    """
+    Cuts text down to at most max_tokens tokens.
+    Falls back to MAX_TRANSCRIPT_CHARS characters if the tokenizer is unavailable.
+    """
+    enc = _get_encoding()
+    if enc is None:
+        return text[:MAX_TRANSCRIPT_CHARS]
 
-    model = genai.GenerativeModel('gemini-2.5-flash')
+    ids = enc.encode(text, disallowed_special=())
+    if len(ids) <= max_tokens:
+        return text
+    return enc.decode(ids[:max_tokens])
 
-    prompt = f"""
+_PROMPT_TMPL = """
 You are a senior QA Engineer and GitHub trends analyst, expert in API testing, automation, and SRE.
 
 Analyze the following GitHub-trends YouTube video and return a DETAILED, COMPREHENSIVE analysis.
@@ -108,7 +320,7 @@ Repo URL: {github_url}
 Description: {video_description}
 
 TRANSCRIPT (TRUNCATED)
-{transcript_text[:25000]}
+{transcript_text}
 
 FORMAT YOUR ANSWER EXACTLY LIKE THIS (INCLUDING BLANK LINES):
 
@@ -126,7 +338,7 @@ FORMAT YOUR ANSWER EXACTLY LIKE THIS (INCLUDING BLANK LINES):
 2. **Personal IoT/Side Project:** [Creative idea. Explain how to use this tech in a home lab or IoT context.]
 
 *GitHub repo link*
-{github_url or "N/A"}
+{github_url}
 
 RULES
 - No strict word limit, but keep it structured and readable.
@@ -134,20 +346,109 @@ RULES
 - Explain *why* this matters for a Senior QA.
 """
 
+def analyze_transcript(transcript_text, video_title, video_description, github_url):
+    """
+    Analyzes the transcript using Gemini to provide a summary, QA, and project ideas.
+    Returns None on failure so the video isn't marked as answered.
+    """
+    if _MODEL is None:
+        logger.error("Error: GEMINI_API_KEY not found.")
+        return None
+
+    transcript_text = truncate_tokens(transcript_text, MAX_TRANSCRIPT_TOKENS)
+
+    prompt = _PROMPT_TMPL.format_map({
+        'video_title': video_title,
+        'github_url': github_url or "N/A",
+        'video_description': video_description,
+        'transcript_text': transcript_text,
+    })
+
+    # Rough estimate: ~4 characters per token
+    _GEMINI_REQUESTS.acquire()
+    _GEMINI_TOKENS.acquire(len(prompt) // 4)
+
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        # Stream so we start reading the response as soon as generation begins
+        parts = []
+        for chunk in _MODEL.generate_content(prompt, stream=True):
+            # The final chunk may carry only the finish reason; chunk.text raises on those
+            if chunk.parts:
+                parts.append(chunk.text)
+        return "".join(parts) or None
     except Exception as e:
-        return f"Error generating AI analysis: {e}"
+        logger.error("Error generating AI analysis: %s", e)
+        return None
 
 # --- Main Batch Job ---
 
+def has_bot_reply(app, channel_id, msg, bot_user_id):
+    """
+    Checks whether the bot already replied in the thread started by msg.
+    Uses the "reply_users" list from the history response when it's complete;
+    Slack caps it at five users, so busier threads fetch their replies instead.
+    """
+    reply_users = msg.get("reply_users", ())
+    if bot_user_id in reply_users:
+        return True
+    if msg.get("reply_users_count", 0) <= len(reply_users):
+        return False
+
+    try:
+        replies = app.client.conversations_replies(channel=channel_id, ts=msg["ts"])
+    except Exception as e:
+        # Treat as processed: stopping here is safer than re-posting for every older video
+        logger.error("  -> Error checking replies (%s): %s", msg["ts"], e)
+        return True
+
+    return any(reply.get("user") == bot_user_id for reply in replies.get("messages", []))
+
+def process_message(app, channel_id, ts, url):
+    """
+    Fetches, analyzes and replies to a single YouTube message.
+    Runs on a worker thread, so errors are reported and swallowed here.
+    """
+    try:
+        logger.info("  -> Processing new video %s: %s", ts, url)
+    
+        # Use yt-dlp to get everything (unless we already have it cached)
+        title, description, transcript = get_video_data_cached(url)
+    
+        if not title or not transcript:
+            logger.warning("  -> Could not fetch video data or transcript (%s).", ts)
+            return
+
+        # Extract the first GitHub URL from description
+        github_match = _GH_URL_RE.search(description or "")
+        github_url = github_match.group(0) if github_match else "N/A"
+
+        analysis = analyze_transcript(transcript, title, description, github_url)
+        if not analysis:
+            # Don't reply, so the video is picked up again on the next run
+            logger.warning("  -> No analysis generated (%s); will retry next run.", ts)
+            return
+
+        # 5. Post Reply
+        logger.info("  -> Posting reply (%s)...", ts)
+        _SLACK_POSTS.acquire()
+        try:
+            app.client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=ts,
+                text=analysis
+            )
+            logger.info("  -> Done (%s).", ts)
+        except Exception as e:
+            logger.error("  -> Error posting reply (%s): %s", ts, e)
+    except Exception as e:
+        logger.error("  -> Error processing video %s: %s", ts, e)
+
 def batch_job():
     slack_token = os.getenv("SLACK_BOT_TOKEN")
     channel_id = os.getenv("SLACK_CHANNEL_ID")
 
     if not slack_token or not channel_id:
-        print("Error: SLACK_BOT_TOKEN or SLACK_CHANNEL_ID not found.")
+        logger.error("Error: SLACK_BOT_TOKEN or SLACK_CHANNEL_ID not found.")
         return
 
     app = App(token=slack_token)
@@ -156,92 +457,74 @@ def batch_job():
     try:
         auth_test = app.client.auth_test()
         bot_user_id = auth_test["user_id"]
-        print(f"Bot User ID: {bot_user_id}")
+        logger.info("Bot User ID: %s", bot_user_id)
     except Exception as e:
-        print(f"Error authenticating: {e}")
+        logger.error("Error authenticating: %s", e)
         return
 
     # 2. Fetch History (last 20 messages)
-    print(f"Fetching history for channel {channel_id}...")
+    logger.info("Fetching history for channel %s...", channel_id)
     try:
         history = app.client.conversations_history(channel=channel_id, limit=20)
     except Exception as e:
-        print(f"Error fetching history: {e}")
+        logger.error("Error fetching history: %s", e)
         return
 
     messages = history.get("messages", [])
-    print(f"Found {len(messages)} messages.")
-
-    for msg in messages:
-        text = msg.get("text", "")
+    logger.info("Found %d messages.", len(messages))
+
+    # 3. Messages are newest first, so everything before the first thread the bot
+    # already answered is new. Stops at the first hit, so fallback lookups stay bounded.
+    cutoff = next(
+        (i for i, msg in enumerate(messages) if has_bot_reply(app, channel_id, msg, bot_user_id)),
+        len(messages),
+    )
+    if cutoff < len(messages):
+        logger.info("  -> Found a video already processed (%s). Stopping search.", messages[cutoff].get("ts"))
+
+    # Only the unprocessed slice needs scanning for YouTube links
+    pending = []
+    for msg in messages[:cutoff]:
         ts = msg.get("ts")
-        
-        # Check for YouTube link
-        url_match = re.search(r"(https?://(www\.)?(youtube\.com|youtu\.be)/[^\s]+)", text)
-        if not url_match:
-            continue
+        url_match = _YT_URL_RE.search(msg.get("text", ""))
+        if url_match:
+            logger.info("Found YouTube link in message %s: %s", ts, url_match.group(0))
+            pending.append((ts, url_match.group(0)))
 
-        print(f"Found YouTube link in message {ts}: {url_match.group(0)}")
-
-        # 3. Check if already replied
-        # We need to check the thread replies
-        if "thread_ts" in msg:
-            thread_ts = msg["thread_ts"]
-        else:
-            thread_ts = ts # If no thread yet, the message ts is the thread starter
-
-        # Fetch thread replies
-        try:
-            replies = app.client.conversations_replies(channel=channel_id, ts=thread_ts)
-            reply_messages = replies.get("messages", [])
-            
-            already_replied = False
-            for reply in reply_messages:
-                if reply.get("user") == bot_user_id:
-                    already_replied = True
-                    break
-            
-            if already_replied:
-                print(f"  -> Found a video already processed ({ts}). Stopping search.")
-                break
-
-        except Exception as e:
-            print(f"  -> Error checking replies: {e}")
-            continue
-
-        # 4. Process Video
-        print(f"  -> Processing new video...")
-        url = url_match.group(0)
-        
-        # Use yt-dlp to get everything
-        title, description, transcript = get_video_data(url)
-        
-        if not title or not transcript:
-            print("  -> Could not fetch video data or transcript.")
-            continue
-
-        # Extract GitHub URLs from description
-        github_urls = re.findall(r"(https?://github\.com/[^\s]+)", description)
-        github_url = github_urls[0] if github_urls else "N/A"
+    if not pending:
+        return
 
-        analysis = analyze_transcript(transcript, title, description, github_url)
+    # 4. Process new videos concurrently (I/O-bound: yt-dlp, captions, Gemini, Slack)
+    logger.info("Processing %d new video(s)...", len(pending))
+    max_workers = min(32, (os.cpu_count() or 1) + 4)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda item: process_message(app, channel_id, *item), pending))
+    finally:
+        close_ydls()
 
-        # 5. Post Reply
-        print("  -> Posting reply...")
-        try:
-            app.client.chat_postMessage(
-                channel=channel_id,
-                thread_ts=ts,
-                text=analysis
-            )
-            print("  -> Done.")
-        except Exception as e:
-            print(f"  -> Error posting reply: {e}")
-        
-        # Sleep briefly to avoid rate limits
-        time.sleep(2)
+def setup_logging():
+    """
+    Routes log records through a queue so worker threads never block on stdout.
+    Returns the listener; stop it to flush pending records.
+    """
+    log_queue = queue.Queue()
+    # QueueHandler formats records before enqueueing them, so the format is set here
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    # httpx logs every request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
 
 if __name__ == "__main__":
-    batch_job()
+    listener = setup_logging()
+    try:
+        batch_job()
+    finally:
+        listener.stop()
 
 
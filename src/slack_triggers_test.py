@@ -1,12 +1,14 @@
-﻿import requests
+﻿import orjson
+import httpx
 import xlsxwriter
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-def fetch_pokemon_data(pokemon_name):
+def fetch_pokemon_data(client, pokemon_name):
     url = f"https://pokeapi.co/api/v2/pokemon/{pokemon_name.lower()}"
-    response = requests.get(url)
+    response = client.get(url)
     if response.status_code == 200:
-        return response.json()
+        return orjson.loads(response.content)
     else:
         print(f"Warning: Failed to fetch data for {pokemon_name}")
         return None
@@ -31,15 +33,20 @@ def parse_pokemon_stats(raw_data):
     }
 
 def create_pokemon_stats_object(pokemon_names):
+    # Fetch concurrently over one HTTP/2 connection
+    with httpx.Client(http2=True, timeout=15, follow_redirects=True) as client, ThreadPoolExecutor(max_workers=8) as executor:
+        raw_results = list(executor.map(lambda name: fetch_pokemon_data(client, name), pokemon_names))
+
     pokemon_summary = []
-    for name in pokemon_names:
-        raw_data = fetch_pokemon_data(name)
+    for raw_data in raw_results:
         if raw_data:
             parsed = parse_pokemon_stats(raw_data)
             pokemon_summary.append(parsed)
     return {"pokemons": pokemon_summary}
 
 
+STAT_KEYS = ("hp", "attack", "defense", "special-attack", "special-defense", "speed")
+
 def create_excel(pokemon_obj, filename="pokemon_stats.xlsx"):
     # Ensure output directory exists
     output_dir = "outputs"
@@ -47,7 +54,8 @@ def create_excel(pokemon_obj, filename="pokemon_stats.xlsx"):
         os.makedirs(output_dir)
 
     filepath = os.path.join(output_dir, filename)
-    workbook = xlsxwriter.Workbook(filepath)
+    # constant_memory streams each row to disk instead of holding the sheet in RAM
+    workbook = xlsxwriter.Workbook(filepath, {'constant_memory': True, 'strings_to_urls': False})
     worksheet = workbook.add_worksheet()
 
     headers = ["Name", "HP", "Attack", "Defense", "Special Attack", "Special Defense", "Speed"]
@@ -55,15 +63,7 @@ def create_excel(pokemon_obj, filename="pokemon_stats.xlsx"):
 
     for row_num, pokemon in enumerate(pokemon_obj["pokemons"], start=1):
         stats = pokemon["stats"]
-        row = [
-            pokemon["name"].capitalize(),
-            stats.get("hp", ""),
-            stats.get("attack", ""),
-            stats.get("defense", ""),
-            stats.get("special-attack", ""),
-            stats.get("special-defense", ""),
-            stats.get("speed", "")
-        ]
+        row = [pokemon["name"].capitalize(), *(stats.get(key, "") for key in STAT_KEYS)]
         worksheet.write_row(row_num, 0, row)
 
     workbook.close()